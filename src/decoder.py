@@ -5,36 +5,55 @@
 from __future__ import annotations
 
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import logging
 import hashlib
 from importlib import import_module
+import multiprocessing
+import os
 from pathlib import Path
 import queue
 import re
 import subprocess
+import time
 from types import ModuleType
-from typing import Callable, Coroutine, List, Optional, Set, Tuple, Self
+from typing import Callable, Coroutine, Dict, List, Optional, Set, Tuple, Self
 
-from attrs import define, field
+from attrs import define, evolve, field
+import orjson
+
+# use the native upb parser, must be set before protobuf is imported
+os.environ.setdefault("PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION", "upb")
 
-from scapy.layers.inet import TCP
-from scapy.all import Packet
 from google.protobuf.any_pb2 import Any
-from google.protobuf.json_format import MessageToJson
+from google.protobuf.internal import api_implementation
+from google.protobuf.json_format import MessageToDict
+from google.protobuf.message import Message as ProtoMessage
 
 from src.utils import (
     ByteArrayRepr,
     GameProtocolConfig,
     Message,
+    MessageBuffer,
     TCP_Message,
     ConfigItem,
+    ConfigValue,
 )
-from src.utils_display import get_tcp_display, print_proto_name, print_varint
+from src.utils_display import format_proto_name, format_varint, get_tcp_display, start
 from src.serialization import serialize_protobuf_message
 from src.profiling import AsyncProfiler
 
 MAX_TRIES_IMPORT = 100
 BUF_SIZE = 65536  # reading the buffer in chunks of BUF_SIZE to avoid reading all the file in once
+MAX_BATCH_SIZE = 16  # messages decoded between two awaits on the message queue
+NATIVE_PROTOBUF_IMPLEMENTATIONS = ("upb", "cpp")
+ANY_TYPE_URL_KEY = 0x0A  # first byte of a serialized Any: type_url, field 1, length-delimited
+
+
+def protobuf_implementation() -> str:
+    """Return the protobuf backend in use, pure python parsing is much slower than upb/cpp."""
+    return str(api_implementation.Type())
 
 
 def compile_proto(proto_path: Path, proto_name: str) -> None:
@@ -106,18 +125,58 @@ def import_proto(
     )
 
 
+def prepare_protos(
+    proto_path: Path,
+    proto_names: List[str],
+    printer: Callable[[str], None],
+) -> Dict[str, str]:
+    """
+    Compile the protos if needed and hash them, in the main process only
+    so the worker processes never run protoc concurrently.
+    Returns the hash of each proto which could be imported.
+    """
+
+    proto_hashes: Dict[str, str] = {}
+    for proto_name in proto_names:
+        if not proto_name:
+            continue
+        try:
+            _, proto_hashes[proto_name] = import_proto(proto_path, proto_name, printer)
+        except Exception as e:
+            printer(f"Cannot load proto {proto_name}: {e}")
+
+    return proto_hashes
+
+
+def compile_filter(names: List[str]) -> Optional[re.Pattern[str]]:
+    """
+    Compile a list of proto names into a single pattern matching any of them.
+    Longer names come first so the most specific one wins.
+    Returns None if there is nothing to match.
+    """
+
+    names = sorted({n for n in names if n}, key=len, reverse=True)
+    if not names:
+        return None
+    return re.compile("|".join(map(re.escape, names)))
+
+
 def parse_varints_from_hex(bytes_msg: bytes) -> Tuple[int, int, ByteArrayRepr]:
     """
     Parse a varint from a hexadecimal string.
     Returns a (varint_value, bytes_consumed, varint_bytes) tuple.
     """
 
+    # most length prefixes fit in a single byte, skip the loop for them
+    if bytes_msg and bytes_msg[0] < 0x80:
+        return bytes_msg[0], 1, ByteArrayRepr.from_bytes(bytes_msg[:1])
+
     position = 0
 
     result = 0
     shift = 0
-    start_pos = position
 
+    # a word/mask decoder was slower: CPython big int arithmetic outweighs the saved branches
     while position < len(bytes_msg):
         byte = bytes_msg[position]
         position += 1
@@ -130,51 +189,225 @@ def parse_varints_from_hex(bytes_msg: bytes) -> Tuple[int, int, ByteArrayRepr]:
         if (byte & 0x80) == 0:
             break
 
-    bytes_consumed = position - start_pos
-
     return (
         result,
-        bytes_consumed,
-        ByteArrayRepr.from_bytes(bytes_msg[start_pos:position]),
+        position,
+        ByteArrayRepr.from_bytes(bytes_msg[:position]),
     )
 
 
+# decoded messages, log lines, display lines, decoding duration in ms
+DecodedBatch = Tuple[List[TCP_Message], List[str], List[str], float]
+InFlightBatch = Tuple[ProcessPoolExecutor, asyncio.Future[DecodedBatch]]
+
+# per worker process, proto name => reused instance of the compiled proto class
+_proto_cache: Dict[str, ProtoMessage] = {}
+# per worker process, reused for every packet, ParseFromString clears it beforehand
+_any_msg = Any()
+
+
+@define(frozen=True)
+class DecoderSettings:
+    """Snapshot of the decoding configuration, sent to the worker processes with each batch."""
+    magic_bytes: bytes
+    display: bool
+    game_version: str
+    proto_path: Path
+    protos: List[str]
+    blacklist: List[str]
+    verbose: bool
+    protos_pattern: Optional[re.Pattern[str]]
+    blacklist_pattern: Optional[re.Pattern[str]]
+    # start of the app, the worker processes import utils_display on their own
+    start_time: float
+    # protos compiled by the main process => hash of their .proto file
+    proto_hashes: Dict[str, str]
+
+    @classmethod
+    def from_config(cls, config: GameProtocolConfig, proto_hashes: Dict[str, str]) -> DecoderSettings:
+        return cls(
+            magic_bytes=config.magic_bytes,
+            display=config.display,
+            game_version=config.game_version,
+            proto_path=config.proto_path,
+            protos=list(config.protos),
+            blacklist=list(config.blacklist),
+            verbose=config.verbose,
+            protos_pattern=compile_filter(config.protos),
+            blacklist_pattern=compile_filter(config.blacklist),
+            start_time=start,
+            proto_hashes=proto_hashes,
+        )
+
+
+    def update(self, key: str, value: ConfigValue) -> DecoderSettings:
+        if key == "protos" and isinstance(value, list):
+            protos = [str(p) for p in value]
+            return evolve(self, protos=protos, protos_pattern=compile_filter(protos))
+        if key == "blacklist" and isinstance(value, list):
+            blacklist = [str(b) for b in value]
+            return evolve(self, blacklist=blacklist, blacklist_pattern=compile_filter(blacklist))
+        if key == "verbose" and isinstance(value, bool):
+            return evolve(self, verbose=value)
+        raise ValueError(f"Unexpected decoder update {key}={value!r}")
+
+
+def decode_messages(msgs: List[Message], settings: DecoderSettings) -> DecodedBatch:
+    """
+    Decode a batch of messages, runs in a worker process.
+    Returns the decoded messages with the lines to write in the log and display panels,
+    and the time spent decoding.
+    """
+
+    start_decoding = time.perf_counter()
+    tcp_msgs: List[TCP_Message] = []
+    # lines are written once per batch, each printer call refreshes the widgets
+    log_lines: List[str] = []
+    display_lines: List[str] = []
+
+    for msg in msgs:
+        # a faulty message must not drop the rest of the batch
+        try:
+            tcp_msg = decode_message(msg, settings, log_lines, display_lines)
+        except Exception as e:
+            log_lines.append(f"Message handler error: {e}")
+            continue
+
+        if tcp_msg is not None:
+            tcp_msgs.append(tcp_msg)
+
+    duration = (time.perf_counter() - start_decoding) * 1000
+    return tcp_msgs, log_lines, display_lines, duration
+
+
+def decode_message(
+    msg: Message,
+    settings: DecoderSettings,
+    log_lines: List[str],
+    display_lines: List[str],
+) -> Optional[TCP_Message]:
+    payload = msg.payload
+
+    # decode the varint
+    value_varint, bytes_consumed, varint_bytes = parse_varints_from_hex(payload)
+
+    # detect messages that spawn on multiple packets
+    # not handled yet
+    if value_varint + bytes_consumed > len(payload):
+        raise ValueError(
+            f"Packet size is {len(payload)} but {value_varint + bytes_consumed} was expected"
+        )
+
+    # if some magic_bytes were given, use them to find the Any protobuf
+    if settings.magic_bytes:
+        magic_number_index = payload.find(settings.magic_bytes)
+        # the Any header (tag and length of type_url) sits right before the magic bytes,
+        # skip packets without room for it or where it is not a type_url key
+        if (
+            magic_number_index < 2
+            or payload[magic_number_index - 2] != ANY_TYPE_URL_KEY
+        ):
+            return None
+        # the reused Any is parsed natively by upb, faster than scanning its wire format in Python
+        _any_msg.ParseFromString(payload[magic_number_index - 2 :])
+        type_url = _any_msg.type_url
+    # else print the payload as ascii for exploration purpose
+    # and stop here
+    else:
+        log_lines.append(payload.decode("ascii", "replace"))
+        log_lines.append("---")
+        return None
+
+    # if verbose, print the name of each proto found unless they are blacklist
+    # it's an exploration feature
+    if (
+        settings.verbose
+        and type_url != ""
+        and (
+            settings.blacklist_pattern is None
+            or settings.blacklist_pattern.search(type_url) is None
+        )
+    ):
+        log_lines.append(format_proto_name(type_url))
+
+    # if the message needs to handle, decode and display it
+    if settings.protos_pattern is not None and (
+        match := settings.protos_pattern.search(type_url)
+    ):
+        proto_filter = match.group()
+        log_lines.extend(get_tcp_display(settings.display, settings.start_time)(*msg.unpack(), None))
+        log_lines.extend(format_varint(value_varint, bytes_consumed, varint_bytes))
+        log_lines.append("---")
+        log_lines.append("Decoding...")
+
+        # protos are compiled by the main process, workers only import them once
+        proto_hash = settings.proto_hashes.get(proto_filter)
+        if proto_hash is None:
+            raise ValueError(f"Proto {proto_filter} was not compiled")
+        proto_msg = _proto_cache.get(proto_filter)
+        if proto_msg is None:
+            proto_module = import_module(f"{proto_filter}_pb2")
+            proto_msg = getattr(proto_module, proto_filter)()
+            _proto_cache[proto_filter] = proto_msg
+        # parse it
+        proto_msg.ParseFromString(_any_msg.value)
+        log_lines.append("---")
+        display_lines.append(format_proto_name(type_url))
+        display_lines.append(
+            orjson.dumps(
+                MessageToDict(proto_msg, preserving_proto_field_name=True),
+                option=orjson.OPT_INDENT_2,
+            ).decode()
+        )
+
+        # create an abstraction for communication with other tasks
+        tcp_msg = TCP_Message(
+            client_ip=f"{msg.dst_ip}:{msg.sport}",
+            server_ip=f"{msg.src_ip}:{msg.dport}",
+            proto=proto_filter,
+            size=value_varint + bytes_consumed,
+            nb_packet=1,
+            data=serialize_protobuf_message(proto_msg),
+            version=settings.game_version,
+            hash=proto_hash,
+        )
+        display_lines.append("-------")
+
+        return tcp_msg
+
+    return None
+
+
 @define
 class TCPDecoder:
     queue_cfg: asyncio.Queue[ConfigItem]
-    queue_msg: queue.Queue[Message]
+    queue_msg: MessageBuffer[Message]
     queue_com: asyncio.Queue[TCP_Message]
     printer_log: Callable[[str], None]
     printer_display: Callable[[str], None]
 
-    _magic_bytes: bytes = field(init=False)
-    _display: bool = field(init=False)
-    _game_version: str = field(init=False)
-    _proto_path: Path = field(init=False)
-    _protos: List[str] = field(init=False)
-    _blacklist: List[str] = field(init=False)
-    _verbose: bool = field(init=False)
-    display_tcp: Callable[[str, str, Packet, Optional[str]], None] = field(init=False)
+    _settings: DecoderSettings = field(init=False)
+    _workers: int = field(init=False)
+    _executor: ProcessPoolExecutor = field(init=False)
 
     @classmethod
     def as_decoder(
         cls,
         queue_cfg: asyncio.Queue[ConfigItem],
-        queue_msg: queue.Queue[Message],
+        queue_msg: MessageBuffer[Message],
         queue_com: asyncio.Queue[TCP_Message],
         config: GameProtocolConfig,
         printer_log: Callable[[str], None],
         printer_display: Callable[[str], None],
     ) -> Self:
         decoder = cls(queue_cfg, queue_msg, queue_com, printer_log, printer_display)
-        decoder._magic_bytes = config.magic_bytes
-        decoder._display = config.display
-        decoder._game_version = config.game_version
-        decoder._proto_path = config.proto_path
-        decoder._protos = config.protos
-        decoder._blacklist = config.blacklist
-        decoder._verbose = config.verbose
-        decoder.display_tcp = get_tcp_display(decoder.printer_log, decoder._display)
+        proto_hashes = prepare_protos(config.proto_path, config.protos, printer_log)
+        decoder._settings = DecoderSettings.from_config(config, proto_hashes)
+        decoder._workers = os.cpu_count() or 1
+        # spawned on every platform, forking the threaded app would copy the sniffer socket and held locks
+        decoder._executor = ProcessPoolExecutor(
+            max_workers=decoder._workers, mp_context=multiprocessing.get_context("spawn")
+        )
 
         return decoder
 
@@ -182,7 +415,7 @@ class TCPDecoder:
     def get_decoder(
         cls,
         queue_cfg: asyncio.Queue[ConfigItem],
-        queue_msg: queue.Queue[Message],
+        queue_msg: MessageBuffer[Message],
         queue_com: asyncio.Queue[TCP_Message],
         config: GameProtocolConfig,
         printer_log: Callable[[str], None],
@@ -194,115 +427,108 @@ class TCPDecoder:
         profiler = AsyncProfiler(logging.getLogger("tcp_sniffer"))
 
         async def decoder() -> None:
-            await asyncio.gather(
-                decoderContainer.handle_messages(profiler),
-                decoderContainer.handle_updates(),
-                return_exceptions=True,
-            )
+            try:
+                await asyncio.gather(
+                    decoderContainer.handle_messages(profiler),
+                    decoderContainer.handle_updates(),
+                    return_exceptions=True,
+                )
+            finally:
+                decoderContainer._executor.shutdown(wait=False, cancel_futures=True)
 
         return decoder
 
     async def handle_messages(self, profiler: AsyncProfiler) -> None:
+        # batches are decoded in parallel but forwarded in order, at most one per worker in flight
+        in_flight = asyncio.Queue[InFlightBatch](maxsize=self._workers)
+        await asyncio.gather(
+            self.submit_batches(in_flight),
+            self.forward_batches(in_flight, profiler),
+        )
+
+    async def submit_batches(self, in_flight: asyncio.Queue[InFlightBatch]) -> None:
+        loop = asyncio.get_running_loop()
         while True:
             try:
-                msg = await asyncio.to_thread(self.queue_msg.get, timeout=1)
-                tcp_msg = await profiler.profile(
-                    "decoder", self.process_tcp_message, msg
-                )
-                if tcp_msg is not None:
-                    await self.queue_com.put(tcp_msg)
+                # wait for one message, then drain what is already buffered
+                msgs = await self.queue_msg.get_batch(MAX_BATCH_SIZE)
+                if dropped := self.queue_msg.take_dropped():
+                    self.printer_log(f"Message buffer full, {dropped} packets dropped !")
+                executor = self._executor
+                try:
+                    future = loop.run_in_executor(
+                        executor, decode_messages, msgs, self._settings
+                    )
+                except BrokenProcessPool:
+                    self.printer_log(f"Decoder workers died, {len(msgs)} messages lost")
+                    self.restart_executor(executor)
+                    continue
+                await in_flight.put((executor, future))
 
-                self.queue_msg.task_done()
+            except Exception as e:
+                self.printer_log(f"Message handler error: {e}")
+
+    async def forward_batches(
+        self,
+        in_flight: asyncio.Queue[InFlightBatch],
+        profiler: AsyncProfiler,
+    ) -> None:
+        while True:
+            try:
+                executor, future = await in_flight.get()
+                try:
+                    tcp_msgs, log_lines, display_lines, duration = await future
+                except BrokenProcessPool:
+                    self.printer_log("Decoder workers died, a batch of messages was lost")
+                    self.restart_executor(executor)
+                    continue
+                profiler.record("decoder", duration)
+
+                if log_lines:
+                    self.printer_log("\n".join(log_lines))
+                if display_lines:
+                    self.printer_display("\n".join(display_lines))
+
+                for tcp_msg in tcp_msgs:
+                    try:
+                        self.queue_com.put_nowait(tcp_msg)
+                    except asyncio.QueueFull:
+                        await self.queue_com.put(tcp_msg)
 
-            except queue.Empty:
-                continue
             except Exception as e:
                 self.printer_log(f"Message handler error: {e}")
 
+    def restart_executor(self, broken: ProcessPoolExecutor) -> None:
+        """Replace a broken pool, unless it was already replaced by another failing batch."""
+        if broken is not self._executor:
+            return
+        broken.shutdown(wait=False, cancel_futures=True)
+        self._executor = ProcessPoolExecutor(
+            max_workers=self._workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.printer_log("Decoder workers restarted")
+
     async def handle_updates(self) -> None:
         while True:
             try:
                 key, value = await self.queue_cfg.get()
-                setattr(self, f"_{key}", value)
+                settings = self._settings.update(key, value)
+
+                # compile the new protos here, off the event loop, before any worker needs them
+                missing = [p for p in settings.protos if p and p not in settings.proto_hashes]
+                if key == "protos" and missing:
+                    lines: List[str] = []
+                    proto_hashes = await asyncio.to_thread(
+                        prepare_protos, settings.proto_path, missing, lines.append
+                    )
+                    self.printer_log("\n".join(lines))
+                    settings = evolve(
+                        settings, proto_hashes={**settings.proto_hashes, **proto_hashes}
+                    )
+
+                self._settings = settings
 
             except queue.Empty:
                 continue
             except Exception as e:
                 self.printer_log(f"Updates handler error: {e}")
-
-    def process_tcp_message(
-        self,
-        msg: Message,
-    ) -> Optional[TCP_Message]:
-        payload = bytes(msg.pkt[TCP].payload)
-
-        # decode the varint
-        value_varint, bytes_consumed, varint_bytes = parse_varints_from_hex(payload)
-
-        # detect messages that spawn on multiple packets
-        # not handled yet
-        if value_varint + bytes_consumed > len(payload):
-            raise ValueError(
-                f"Packet size is {len(payload)} but {value_varint + bytes_consumed} was expected"
-            )
-
-        # if some magic_bytes were given, use them to find the Any protobuf
-        if self._magic_bytes:
-            magic_number_index = -1
-            if self._magic_bytes in payload:
-                magic_number_index = payload.index(self._magic_bytes)
-            any_msg = Any()
-            any_msg.ParseFromString(payload[magic_number_index - 2 :])
-        # else print the payload as ascii for exploration purpose
-        # and stop here
-        else:
-            self.printer_log(payload.decode("ascii", "replace"))
-            self.printer_log("---")
-            return None
-
-        # if verbose, print the name of each proto found unless they are blacklist
-        # it's an exploration feature
-        if (
-            self._verbose
-            and not any(b in any_msg.type_url for b in self._blacklist)
-            and any_msg.type_url != ""
-        ):
-            print_proto_name(self.printer_log, any_msg)
-
-        # if the message needs to handle, decode and display it
-        if self._protos != [""] and any(
-            (proto_filter := p) in any_msg.type_url for p in self._protos
-        ):
-            self.display_tcp(*msg.unpack(), None)
-            print_varint(self.printer_log, value_varint, bytes_consumed, varint_bytes)
-            self.printer_log("---")
-            self.printer_log("Decoding...")
-
-            # import desired proto file, compile it if needed
-            proto_module, proto_hash = import_proto(
-                self._proto_path, proto_filter, self.printer_log
-            )
-            proto_class = getattr(proto_module, proto_filter)
-            proto_msg = proto_class()
-            # parse it
-            proto_msg.ParseFromString(any_msg.value)
-            self.printer_log("---")
-            print_proto_name(self.printer_display, any_msg)
-            self.printer_display(MessageToJson(proto_msg))
-
-            # create an abstraction for communication with other tasks
-            tcp_msg = TCP_Message(
-                client_ip=f"{msg.dst_ip}:{msg.pkt[TCP].sport}",
-                server_ip=f"{msg.src_ip}:{msg.pkt[TCP].dport}",
-                proto=proto_filter,
-                size=value_varint + bytes_consumed,
-                nb_packet=1,
-                data=serialize_protobuf_message(proto_msg),
-                version=self._game_version,
-                hash=proto_hash,
-            )
-            self.printer_display("-------")
-
-            return tcp_msg
-
-        return None
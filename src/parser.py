@@ -2,11 +2,18 @@ import asyncio
 from pathlib import Path
 from typing import Callable, Coroutine, Sequence 
 
-from argparse import ArgumentParser, Namespace 
+from argparse import ArgumentParser, ArgumentTypeError, Namespace 
 
 from src.utils import ConfigItem, GameProtocolConfig
 
 
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
 def tcp_parser() -> ArgumentParser:
     parser = ArgumentParser(
         description="TCP Game Protocol Analyzer - Monitor client-server communication patterns"
@@ -69,6 +76,12 @@ def tcp_parser() -> ArgumentParser:
         default=False,
         help="Display all protobuf messages found (default: False)"
     )
+    parser.add_argument(
+        '--buffer-size',
+        type=positive_int,
+        default=100,
+        help="Number of sniffed packets waiting for the decoder before the oldest are dropped (default: 100)"
+    )
     return parser
 
 
@@ -107,6 +120,7 @@ def create_start_config_from_args(arguments: Sequence[str]) -> GameProtocolConfi
         game_version=args.game_version,
         display=args.display,
         verbose=args.verbose,
+        buffer_size=args.buffer_size,
     )
 
 
@@ -2,89 +2,71 @@
 # See LICENSE file for extended copyright information.
 # This file is part of GameTCPSniffer project from https://github.com/remyCases/GameTCPSniffer.
 
-import asyncio
-import queue
-import re
-import subprocess
 from typing import Callable, List, Tuple
 
+import psutil
 from scapy.all import Packet
 from scapy.layers.inet import IP, TCP
 
-from src.utils import CommunicationFlag, Message, is_client
+from src.utils import CommunicationFlag, Message, MessageBuffer, ip_to_int, is_client
 
 
 def get_game_servers(
     ports: List[int],
     printer: Callable[[str], None],
 ) -> List[Tuple[str, int]]:
-    """Find current server IPs given some specific ports by scanning netstat"""
+    """Find current server IPs given some specific ports by listing the established TCP connections"""
     try:
-        # Get netstat output
-        result = subprocess.run(['netstat', '-an'], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        if result.returncode != 0:
-            printer(f"Netstat failed: {result.stderr!r}")
-            return []
-
-        try:
-            # decode stdout as utf8 string
-            output = result.stdout.decode('utf-8')
-        except UnicodeDecodeError:
-            # fallback to cp1252 with error handling
-            output = result.stdout.decode('cp1252', errors='ignore')
-
-        lines = output.split('\n')
         servers: List[Tuple[str, int]] = []
 
-        for line in lines:
-            if "ESTABLISHED" in line and "TCP" in line:
-                # Extract IP and port from netstat line
-                match = re.search(r"(\d+\.\d+\.\d+\.\d+):(\d+)[\s]+(\d+\.\d+\.\d+\.\d+):(\d+)", line)
-                if match:
-                    ip = match.group(3)
-                    port = int(match.group(4))
+        for conn in psutil.net_connections(kind="tcp4"):
+            if conn.status != psutil.CONN_ESTABLISHED or not conn.raddr:
+                continue
+
+            ip, port = conn.raddr.ip, conn.raddr.port
 
-                    # Look for our target ports
-                    if port in ports:
-                        # Make sure it's not localhost
-                        if not is_client(ip):
-                            servers.append((ip, port))
+            # Look for our target ports
+            if port in ports:
+                # Make sure it's not localhost
+                if not is_client(ip_to_int(ip)):
+                    servers.append((ip, port))
 
         return servers
 
     except Exception as e:
-        printer(f"Error scanning netstat: {e}")
+        printer(f"Error listing connections: {e}")
         return []
 
 
+def build_bpf_filter(servers: List[Tuple[str, int]]) -> str:
+    """Build a BPF filter only letting through TCP packets from or to the given servers"""
+    hosts = " or ".join(f"(host {ip} and port {port})" for ip, port in servers)
+    return f"tcp and ({hosts})"
+
+
 def generate_packet_handler(
-    db_queue_for_decoder: queue.Queue[Message],
-    printer: Callable[[str], None],
-) -> Callable[[Packet, List[str]], None]:
+    buffer_for_decoder: MessageBuffer[Message],
+) -> Callable[[Packet], None]:
 
-    def packet_handler(pkt: Packet, servers: List[str]) -> None:
+    def packet_handler(pkt: Packet) -> None:
         """
-        Filters TCP packets following a list of servers.
+        Forwards TCP packets to the decoder.
+        Packets are already filtered on the monitored servers by the BPF filter of the sniffer.
 
         Args:
             pkt: Scapy packet object
-            servers: List of server IPs to monitor
-            filter_payload_len: Expected ACK packet size (-1 for no filtering)
         """
 
-        if pkt.haslayer(TCP) and pkt.haslayer(IP):
-            src_ip = pkt[IP].src
-            dst_ip = pkt[IP].dst
-
-            if (src_ip in servers or dst_ip in servers):
+        # each layer access walks the packet, look them up once
+        ip = pkt.getlayer(IP)
+        tcp = pkt.getlayer(TCP)
+        if ip is None or tcp is None:
+            return
 
-                msg = Message(src_ip, dst_ip, pkt, CommunicationFlag.OTHER)
-                try:
-                    db_queue_for_decoder.put_nowait(msg)
-                except asyncio.QueueFull:
-                    printer("Database queue full !")
-                return
+        # materialize the payload once, scapy rebuilds it on each access
+        payload = bytes(tcp.payload)
+        msg = Message(ip.src, ip.dst, tcp.sport, tcp.dport, CommunicationFlag.OTHER, payload)
+        buffer_for_decoder.push(msg)
 
     return packet_handler
 
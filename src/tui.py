@@ -1,7 +1,5 @@
 import asyncio
-from typing import Any, List, Sequence
-import queue
-import threading
+from typing import List, Sequence
 import logging
 
 import aiofiles
@@ -11,7 +9,7 @@ from textual.widgets import Static, Input, RichLog
 from textual.events import Key
 from textual.containers import Vertical, Horizontal
 from textual.suggester import SuggestFromList
-from scapy.all import sniff, Packet
+from scapy.all import AsyncSniffer
 from rich.text import Text
 
 from src.parser import (
@@ -19,10 +17,10 @@ from src.parser import (
     create_runtime_parser,
     create_start_config_from_args,
 )
-from src.servers import get_game_servers, generate_packet_handler
-from src.decoder import TCPDecoder
+from src.servers import build_bpf_filter, get_game_servers, generate_packet_handler
+from src.decoder import NATIVE_PROTOBUF_IMPLEMENTATIONS, TCPDecoder, protobuf_implementation
 from src.database import get_database_worker, get_last_session_id
-from src.utils import Message, TCP_Message, ConfigItem
+from src.utils import Message, MessageBuffer, TCP_Message, ConfigItem
 
 
 class TCPSnifferApp(App[None]):
@@ -59,6 +57,12 @@ class TCPSnifferApp(App[None]):
         )
         self.add_message_and_log(f"{'Capturing protos':<35}: {self.config.protos}")
         self.add_message_and_log(f"{'Ignoring protos':<35}: {self.config.blacklist}")
+        implementation = protobuf_implementation()
+        self.add_message_and_log(f"{'Protobuf implementation':<35}: {implementation}")
+        if implementation not in NATIVE_PROTOBUF_IMPLEMENTATIONS:
+            self.logger.warning(
+                "Protobuf is running its pure python implementation, decoding will be slow. Install protobuf>=4.21."
+            )
         self.add_message_and_log("Getting servers...")
 
         servs = get_game_servers(self.config.ports, printer)
@@ -70,7 +74,7 @@ class TCPSnifferApp(App[None]):
                 f"Script is closing, no servers on port {self.config.ports} were found."
             )
         self.add_message_and_log(f"Starting packet capture for {servs} servers...")
-        self.ip_servs = [ip for (ip, _) in servs]
+        bpf_filter = build_bpf_filter(servs)
 
         async with aiosqlite.connect(self.config.db_path / "tcp.db") as db:
             async with aiofiles.open(self.config.sc_path, encoding="utf-8") as file:
@@ -81,12 +85,11 @@ class TCPSnifferApp(App[None]):
         self.db_connection = await aiosqlite.connect(self.config.db_path / "tcp.db")
         last_session_id = await get_last_session_id(self.db_connection)
 
-        # event to cancel threads
-        self.cancel_event = threading.Event()
-
         # queue for communication between tasks
         queue_cfg_decoder = asyncio.Queue[ConfigItem](maxsize=100)
-        queue_msg_decoder = queue.Queue[Message](maxsize=100)
+        queue_msg_decoder = MessageBuffer[Message](
+            asyncio.get_running_loop(), maxlen=self.config.buffer_size
+        )
         queue_com_decoder = asyncio.Queue[TCP_Message](maxsize=100)
 
         self.command_processor = CommandProcessor(
@@ -98,25 +101,15 @@ class TCPSnifferApp(App[None]):
             self.runtime_parser.format_usage(),
         )
 
-        # sniffer thread
-        packet_handler = generate_packet_handler(queue_msg_decoder, printer)
-
-        def custom_prn(pkt: Packet) -> None:
-            return packet_handler(pkt, self.ip_servs)
-
-        def custom_stop_filter(_: Any) -> bool:
-            return self.cancel_event.is_set()
-
-        sn_task = asyncio.create_task(
-            asyncio.to_thread(
-                lambda: sniff(
-                    filter="tcp",
-                    prn=custom_prn,
-                    store=0,
-                    stop_filter=custom_stop_filter,
-                )
-            )
+        # sniffer thread, stopped explicitly on exit since the BPF filter
+        # may not let any packet through to evaluate a stop filter
+        packet_handler = generate_packet_handler(queue_msg_decoder)
+        self.sniffer = AsyncSniffer(
+            filter=bpf_filter,
+            prn=packet_handler,
+            store=False,
         )
+        self.sniffer.start()
 
         # decoder task
         de_worker = TCPDecoder.get_decoder(
@@ -138,7 +131,6 @@ class TCPSnifferApp(App[None]):
         self.add_message_and_log("Database worker started")
 
         self.tasks = [
-            sn_task,
             de_task,
             db_task,
         ]
@@ -239,8 +231,8 @@ class TCPSnifferApp(App[None]):
     async def on_exit(self) -> None:
         self.logger.info("Cleaning up...")
 
-        if hasattr(self, "cancel_event"):
-            self.cancel_event.set()
+        if hasattr(self, "sniffer") and self.sniffer.running:
+            await asyncio.to_thread(self.sniffer.stop)
 
         if hasattr(self, "tasks"):
             for task in self.tasks:
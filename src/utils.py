@@ -6,16 +6,21 @@ from __future__ import annotations
 
 import asyncio
 import binascii
+import socket
+from collections import deque
 from enum import Enum
 from pathlib import Path
-from typing import List, Tuple
+from typing import Deque, Generic, List, Optional, Tuple, TypeVar
 
-from attr import define, field
+from attr import Factory, define, field
 from attrs import fields
 from scapy.all import Packet
 from scapy.layers.inet import TCP
 
 
+T = TypeVar("T")
+
+
 class CommunicationFlag(Enum):
     ACK = "ack"
     OTHER = "other"
@@ -38,11 +43,13 @@ class ByteArrayRepr:
 class Message:
     src_ip: str
     dst_ip: str
-    pkt: Packet
+    sport: int
+    dport: int
     flag: CommunicationFlag
+    payload: bytes
 
-    def unpack(self) -> Tuple[str, str, Packet]:
-        return self.src_ip, self.dst_ip, self.pkt
+    def unpack(self) -> Tuple[str, str, int, int, bytes]:
+        return self.src_ip, self.dst_ip, self.sport, self.dport, self.payload
 
 
     @classmethod
@@ -50,11 +57,63 @@ class Message:
         return Message(
             src_ip="",
             dst_ip="",
-            pkt=Packet(),
+            sport=0,
+            dport=0,
             flag=CommunicationFlag.OTHER,
+            payload=b"",
         )
 
 
+@define
+class MessageBuffer(Generic[T]):
+    """
+    Hands items over from a producer thread to an asyncio consumer.
+    Appending to a deque is atomic under the GIL, so no lock is taken, and the event loop
+    is only woken up when the consumer waits for new items.
+    When maxlen is reached, the oldest items are dropped and counted.
+    """
+    _loop: asyncio.AbstractEventLoop
+    maxlen: Optional[int] = None
+    _items: Deque[T] = field(
+        init=False, default=Factory(lambda self: deque(maxlen=self.maxlen), takes_self=True)
+    )
+    _event: asyncio.Event = field(factory=asyncio.Event, init=False)
+    # only written by the producer, the consumer keeps track of what it already reported
+    dropped: int = field(default=0, init=False)
+    _reported: int = field(default=0, init=False)
+
+    def push(self, item: T) -> None:
+        """Thread-safe, can be called outside of the event loop."""
+        if self.maxlen is not None and len(self._items) >= self.maxlen:
+            self.dropped += 1
+        self._items.append(item)
+        if not self._event.is_set():
+            self._loop.call_soon_threadsafe(self._event.set)
+
+
+    async def get_batch(self, max_size: int) -> List[T]:
+        """Wait for at least one item and return up to max_size of them."""
+        while not self._items:
+            self._event.clear()
+            # an item may have been pushed while the event was still set
+            if self._items:
+                break
+            await self._event.wait()
+
+        batch: List[T] = []
+        while self._items and len(batch) < max_size:
+            batch.append(self._items.popleft())
+        return batch
+
+
+    def take_dropped(self) -> int:
+        """Return the number of items dropped since the last call, from the consumer side."""
+        dropped = self.dropped
+        new_drops = dropped - self._reported
+        self._reported = dropped
+        return new_drops
+
+
 @define
 class TCP_Message:
     client_ip: str
@@ -82,7 +141,8 @@ class Communication:
         return self.client_ip, self.server_ip, self.request, self.ack, self.response
 
 
-ConfigItem = Tuple[str, List[int] | List[str] | bytes | Path | str | bool]
+ConfigValue = List[int] | List[str] | bytes | Path | str | bool
+ConfigItem = Tuple[str, ConfigValue]
 
 @define
 class GameProtocolConfig:
@@ -96,6 +156,7 @@ class GameProtocolConfig:
     game_version: str
     display: bool
     verbose: bool
+    buffer_size: int
     _lock: asyncio.Lock = field(factory=asyncio.Lock, init=False)
 
 
@@ -159,6 +220,10 @@ class GameProtocolConfig:
                 args.append(f"--{name}")
                 args.append(str(value))
 
+            elif isinstance(value, int) and not isinstance(value, bool):
+                args.append(f"--{name}")
+                args.append(str(value))
+
         return args
 
 
@@ -166,7 +231,12 @@ def decode_tcp_paylod(pkt: Packet) -> str:
     return binascii.hexlify(bytes(pkt[TCP].payload)).decode()
 
 
-def is_client(ip: str) -> bool:
+def ip_to_int(ip: str) -> int:
+    """Convert a dotted IPv4 address to its 32 bits integer."""
+    return int.from_bytes(socket.inet_aton(ip), "big")
+
+
+def is_client(ip: int) -> bool:
     """Return True if localhost."""
-    return ip.startswith("127.") or ip.startswith("192.168.")
+    return (ip & 0xFF000000) == 0x7F000000 or (ip & 0xFFFF0000) == 0xC0A80000
 